@@ -1,6 +1,38 @@
-from socket import socket
+from logging import getLogger, StreamHandler, DEBUG
+from logging.handlers import MemoryHandler
+from selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+from socket import socket, IPPROTO_TCP, SOL_SOCKET, SO_KEEPALIVE, SO_RCVBUF, TCP_NODELAY
+import sys
+from sys    import intern
 from time   import time, sleep
 
+# byte strings searched for in received lines
+_ACK_PREFIX     = b"CAP * ACK :twitch.tv/" # followed by the name of the granted capability
+_NAMES_END      = b"End of /NAMES list"
+_PING           = b"PING"
+_SERVER_PREFIX  = b":tmi.twitch.tv "
+_BADGE_INFO     = b"@badge-info="
+
+# responses which mean the login has failed, and the reason given to the user
+_LOGIN_ERRORS = (
+	(b"Invalid NICK",              "invalid username"),
+	(b"Improperly formatted auth", "login details are incorrect"),
+)
+
+_PONG_MSG = b"PONG :tmi.twitch.tv\r\n" # the reply to every PING, so only encoded once
+
+# keys used in the returned message dicts - interned once, so every dict shares the same key objects (with cached hashes)
+_K_MSG_TYPE    = intern("message_type")
+_K_DISPLAY     = intern("display-name")
+_K_MESSAGE     = intern("message")
+_K_MSG_ID      = intern("msg_id")
+_K_HOST_TARGET = intern("host_target")
+_K_VIEWERS     = intern("viewers")
+
+# Tag names seen so far, as raw bytes -> decoded and interned str. The same few dozen names appear on every line,
+# so they're only decoded once, and every message dict shares the same key objects.
+_tag_keys = {}
+
 class NotInitialisedException(Exception):
 	def __init__(self, args):
 		if args:
@@ -8,6 +40,152 @@ class NotInitialisedException(Exception):
 		else:
 			self.message = None
 
+def _parse_tags(line, pos, tags=None):
+	"""
+	Parses the IRCv3 tags at the start of a line (as bytes), beginning at pos (the character after the leading @).
+
+	Tags are added to the tags dict if one is given, otherwise to a new dict.
+	Returns a tuple of (dict of tag keys to values, index of the first character after the tags).
+	"""
+	if tags is None:
+		tags = {}
+	end_of_tags = line.find(b" ", pos)
+	if end_of_tags == -1:
+		end_of_tags = len(line)
+
+	# one split of just the tags section, then partition each tag - both run in C, so this is faster than finding each delimiter from Python
+	get_key = _tag_keys.get
+	for tag in line[pos:end_of_tags].split(b";"):
+		key, equals, value = tag.partition(b"=")
+		if equals: # sanity check - all should have key=value
+			name = get_key(key)
+			if name is None:
+				name = intern(key.decode("utf-8", "replace"))
+				if len(_tag_keys) < 256: # Twitch only uses a few dozen tag names, so this is just a safety limit
+					_tag_keys[key] = name
+			tags[name] = value.decode("utf-8", "replace")
+
+	return tags, end_of_tags + 1
+
+def _handle_privmsg(line, bot, end_of_command):
+	"""Chat message from a user."""
+	message_dict = {_K_MSG_TYPE:"privmsg"}
+
+	try:
+		if bot._tags_granted and line[0:1] == b"@":
+			_parse_tags(line, 1, message_dict)
+		else:
+			# line starts with :username!username@username.tmi.twitch.tv - usernames are at most 25 characters,
+			# so there's no need to search past the first few bytes for the end of the name
+			end_of_name = line.find(b"!", 1, 64)
+			if not 4 <= end_of_name - 1 <= 25: # min and max lengths for username.. just a sanity check (also catches no "!" found)
+				raise ValueError("Unable to find username in line.")
+			message_dict[_K_DISPLAY] = line[1:end_of_name].decode("utf-8", "replace").lower()
+		start_of_message = line.index(b":", end_of_command) + 1 # everything after the PRIVMSG.. then after the subsequent colon
+		message_dict[_K_MESSAGE] = line[start_of_message:].decode("utf-8", "replace")
+	except (ValueError, IndexError) as ex:
+		if bot.debug:
+			bot._log.debug(f"Unable to parse line as message: \n\n{line.decode('utf-8', 'replace')} \n\n{str(ex)}")
+		return None # bad line
+
+	return message_dict
+
+def _handle_notice(line, bot, end_of_command):
+	"""Example NOTICE message: @msg-id=color_changed :tmi.twitch.tv NOTICE #kaywee :Your color has been changed."""
+	message_dict = {_K_MSG_TYPE:"notice"}
+	if line[0:1] == b"@": # notices sent before login (e.g. login failures) have no tags
+		msg_tags, _ = _parse_tags(line, 1)
+		message_dict[_K_MSG_ID] = msg_tags.get("msg-id")
+	start_of_message = line.find(b" :", end_of_command) # the message can contain colons, so it's everything after the first " :"
+	message_dict[_K_MESSAGE] = line[start_of_message+2:].decode("utf-8", "replace") if start_of_message != -1 else ""
+	return message_dict
+
+def _handle_usernotice(line, bot, end_of_command):
+	message_dict = {_K_MSG_TYPE:"usernotice"}
+	_parse_tags(line, 1, message_dict) # skip the leading @
+	return message_dict
+
+def _handle_userstate(line, bot, end_of_command):
+	"""Example message:
+	@badge-info=subscriber/7;badges=moderator/1,subscriber/6;color=#FF69B4;display-name=RoboKaywee;
+	emote-sets=0,300374282,300542926,537206155,564265402,592920959,610186276;mod=1;subscriber=1;user-type=mod :tmi.twitch.tv USERSTATE #kaywee
+	"""
+	message_dict = {_K_MSG_TYPE:"userstate"} # what info comes with this?
+	_parse_tags(line, 1, message_dict) # skip the leading @
+	return message_dict
+
+def _handle_hosttarget(line, bot, end_of_command):
+	"""Example message: :tmi.twitch.tv HOSTTARGET #kaywee :otherchannel 12 (target is "-" when hosting stops)"""
+	start_of_params = line.find(b" :", end_of_command)
+	if start_of_params == -1:
+		return None
+	target, _, viewers = line[start_of_params+2:].partition(b" ")
+	if target not in (b"-", b""):
+		return {_K_MSG_TYPE:"hosttarget", _K_HOST_TARGET: target.decode("utf-8", "replace"), _K_VIEWERS: viewers.decode("utf-8", "replace")}
+	return None
+
+def _handle_reconnect(line, bot, end_of_command):
+	"""A command to reconnect to chat."""
+	bot.reset_socket() # reconnect to chat per twitch's request
+	return None # don't return this as a message type
+
+def _handle_clearmsg(line, bot, end_of_command):
+	"""Single message was deleted."""
+	message_dict = {_K_MSG_TYPE:"clearmsg"}
+	if bot._tags_granted and line[0:1] == b"@":
+		_parse_tags(line, 1, message_dict)
+	return message_dict
+
+def _handle_clearchat(line, bot, end_of_command):
+	"""Clear all messages from user."""
+	message_dict = {_K_MSG_TYPE:"clearchat"}
+	if bot._tags_granted and line[0:1] == b"@":
+		_parse_tags(line, 1, message_dict)
+	return message_dict
+
+def _handle_roomstate(line, bot, end_of_command):
+	"""Example message:
+	@room-id=136108665;subs-only=0 :tmi.twitch.tv ROOMSTATE #kaywee
+	"""
+	message_dict = {_K_MSG_TYPE:"roomstate"}
+	_parse_tags(line, 1, message_dict) # skip the leading @
+	return message_dict
+
+def _handle_unknown(line, bot, end_of_command):
+	if line.startswith(_BADGE_INFO):
+		message_dict = {_K_MSG_TYPE:"badge-info"}
+		_parse_tags(line, 1, message_dict) # skip the leading @
+		return message_dict
+
+	if bot._verbose_log is None: # opened on first use, then kept open so lines are written in buffered batches
+		bot._verbose_log = open("verbose log.txt", "ab", buffering=65536)
+	bot._verbose_log.write(b"Unrecognised line received in Chatbot: " + line + b"\n\n")
+	return None
+
+# Maps IRC commands to the function which turns a line with that command into a message dict (or None).
+# Each function is given the line, the bot, and the index just after the command, so it can go straight to the parameters.
+_DISPATCH = {
+	b"PRIVMSG":    _handle_privmsg,
+	b"NOTICE":     _handle_notice,
+	b"USERNOTICE": _handle_usernotice,
+	b"USERSTATE":  _handle_userstate,
+	b"HOSTTARGET": _handle_hosttarget,
+	b"RECONNECT":  _handle_reconnect,
+	b"CLEARMSG":   _handle_clearmsg,
+	b"CLEARCHAT":  _handle_clearchat,
+	b"ROOMSTATE":  _handle_roomstate,
+}
+
+_CAPABILITIES = ("tags", "membership", "commands") # all the capabilities which can be requested
+
+_LOGIN_TIMEOUT = 5 # seconds to wait for each response from the server while logging in
+
+_SEND_TIMEOUT = 10 # seconds to wait for room in the send buffer before giving up on the server
+
+_RECV_SIZE = 65536 # bytes to read from the socket at once
+
+_MAX_READBUFFER = 65536 # bytes - far longer than any valid line, so a buffer this big with no line ending is junk
+
 class ChatBot():
 	"""
 	Creates a chatbot which can send and receive messages in a Twitch channel's chat.
@@ -20,7 +198,7 @@ class ChatBot():
 
 	Keyword Args (optional):
 
-	debug=True      (default: False) - print debug messages to console
+	debug=True      (default: False) - print debug messages to console (written in batches, via the "chatbot" logger)
 	capabilities=[] (default: empty) - a list of lowercase strings of additional capabilities to request - see https://dev.twitch.tv/docs/irc/guide/#twitch-irc-capabilities
 	
 	"""
@@ -32,111 +210,131 @@ class ChatBot():
 		self.password = password
 		self.channel  = channel.lower()
 
+		self._privmsg_prefix = ("PRIVMSG #" + self.channel + " :").encode('utf-8') # the same for every message we send
+
 		self.requested_capabilities = []
 		self.granted_capabilities = []
 
 		if "debug" in kwargs:
 			# only set debug mode if the debug flag is explicitly True, i.e. not for truthy objects such as non-empty strings.
 			self.debug = kwargs["debug"] is True 
-			if self.debug:
-				print(f"Debugging is turned on.")
 		else:
 			self.debug = False
 
+		# Debug messages are buffered and written out in batches, rather than making a separate write to the console for every line received.
+		# They're flushed at the end of every call to get_messages, and by close().
+		# The logger is shared by every bot, so each message is only logged if this bot has debug turned on - the level is only
+		# ever raised, so a bot without debug turned on can't silence one which has it.
+		self._log = getLogger("chatbot")
+		if self.debug:
+			self._log.setLevel(DEBUG)
+			if not self._log.handlers: # only add the handler once, however many bots are created
+				self._log.addHandler(MemoryHandler(256, target=StreamHandler(sys.stdout))) # looked up now, in case stdout has been redirected since import
+				self._log.propagate = False # otherwise an app with its own root handler would get every line twice
+			self._log.debug("Debugging is turned on.")
+
 		if "capabilities" in kwargs:
-			if "tags" in kwargs["capabilities"]:
-				self.requested_capabilities.append("tags")
-				if self.debug:
-					print("Requesting tags capability")
-			if "membership" in kwargs["capabilities"]:
-				self.requested_capabilities.append("membership")
-				if self.debug:
-					print("Requesting membership capability")
-			if "commands" in kwargs["capabilities"]:
-				self.requested_capabilities.append("commands")
-				if self.debug:
-					print("Requesting commands capability")
+			self.requested_capabilities = [cap for cap in _CAPABILITIES if cap in kwargs["capabilities"]]
+			if self.debug:
+				for cap in self.requested_capabilities:
+					self._log.debug(f"Requesting {cap} capability")
+
+		self._verbose_log = None
+
+		# every receive in get_messages reads into this same buffer, rather than allocating a new bytes object each time
+		self._recv_buffer = memoryview(bytearray(_RECV_SIZE))
+
 		self._open_socket()
 
 	def _open_socket(self):
+		self._readbuffer = bytearray() # received bytes which don't yet make up a complete line
 		self.socket = socket()
+		self.socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1) # send each message straight away rather than waiting to batch small writes
+		self.socket.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1) # notice if the connection dies while chat is quiet
+		# Make sure there's room for a burst of chat to queue up between calls to get_messages.
+		# This only ever raises the size - some OSes already default to more, and setting it turns off their automatic tuning.
+		if self.socket.getsockopt(SOL_SOCKET, SO_RCVBUF) < _RECV_SIZE:
+			self.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, _RECV_SIZE)
 		self.socket.connect(("irc.twitch.tv", 6667))
+		self._send = self.socket.send # bound once per socket, rather than looking up the method on every send
+		self._selector = DefaultSelector()
+		self._selector.register(self.socket, EVENT_READ)
 
 		opening_request = "PASS {password}\r\nNICK {username}\r\nJOIN #{channel}\r\n"
 
-		if self.requested_capabilities:
-			if "tags" in self.requested_capabilities:
-				opening_request += "CAP REQ :twitch.tv/tags\r\n"
-			if "membership" in self.requested_capabilities:
-				opening_request += "CAP REQ :twitch.tv/membership\r\n"
-			if "commands" in self.requested_capabilities:
-				opening_request += "CAP REQ :twitch.tv/commands\r\n"
+		opening_request += "".join(f"CAP REQ :twitch.tv/{cap}\r\n" for cap in self.requested_capabilities)
 
 		opening_request = opening_request.format(password=self.password, username=self.username, channel=self.channel).encode("utf-8")
-		self.socket.send(opening_request)
-
-		readbuffer = ""
-		success = False
-
-		while not success:
-			next_bytes = self.socket.recv(4096).decode("utf-8")
-			readbuffer += str(next_bytes)
-			response_lines = readbuffer.split("\r\n")
-
-			if response_lines == [""]: # this happens sometimes
+		self.socket.sendall(opening_request) # still blocking at this point, and not yet initialised, so _sendall isn't needed
+
+		debug = self.debug
+		names_received = False
+		self.granted_capabilities.clear() # in case this is a reconnect
+
+		# Keep receiving until the end of the names list, which means we've joined the channel.
+		# If Capabilities are requested, sometimes the ACKs come through after that, so if we've not heard back
+		# the ACK for all of the requested capabilities, we keep waiting for those too.
+		# Every wait is bounded, so a server which stops responding can't hang the bot forever.
+		while not names_received or len(self.granted_capabilities) < len(self.requested_capabilities):
+			if not self._selector.select(_LOGIN_TIMEOUT):
+				if names_received:
+					if debug:
+						self._log.debug("Not all requested capabilities were granted.")
+					break
+				raise NotInitialisedException("Unable to log into Twitch: login timed out.")
+
+			next_bytes = self.socket.recv(_RECV_SIZE) # reads everything that has arrived so far, not just one small chunk
+			if not next_bytes: # this happens sometimes
 				raise NotInitialisedException("Unable to log into Twitch: no response received.")
+			self._readbuffer += next_bytes
+
+			for line in self._pop_lines(): # if the first chat message arrives while waiting for ACKs, it won't be processed.
+				if debug:
+					self._log.debug(line.decode("utf-8", "replace"))
+
+				# each line is only searched until it's recognised - error checks come last as they're the rare case
+				if _NAMES_END in line:
+					names_received = True
+					continue
+
+				start_of_ack = line.find(_ACK_PREFIX) # one search, whichever capability it is
+				if start_of_ack != -1:
+					capability = line[start_of_ack+len(_ACK_PREFIX):].decode("utf-8", "replace")
+					if capability in _CAPABILITIES and capability not in self.granted_capabilities:
+						self.granted_capabilities.append(capability)
+						if debug:
+							self._log.debug(f"{capability.capitalize()} capability granted.")
+					continue
+
+				for error, reason in _LOGIN_ERRORS:
+					if error in line:
+						raise NotInitialisedException(f"Unable to log into Twitch: {reason}.")
+
+		self._flush_log() # so the login shows up straight away, rather than with the first batch of messages
+		self._tags_granted = "tags" in self.granted_capabilities # checked for every message, so worked out once here
+		self.socket.setblocking(False) # get_messages waits on the selector, then reads everything available without blocking
+
+		self._recv_into = self.socket.recv_into # bound once per socket, rather than looking up the method on every receive
+		self.initialised = True
 
-			for line in response_lines:
-				if self.debug:
-					print(line)
-				if "Invalid NICK" in line:
-					raise NotInitialisedException("Unable to log into Twitch: invalid username.")
-				elif "Improperly formatted auth" in line:
-					raise NotInitialisedException("Unable to log into Twitch: login details are incorrect.")
-
-				if "CAP * ACK :twitch.tv/membership" in line:
-					self.granted_capabilities.append("membership")
-					if self.debug:
-						print("Membership capability granted.")
-				if "CAP * ACK :twitch.tv/commands" in line:
-					self.granted_capabilities.append("commands")
-					if self.debug:
-						print("Commands capability granted.")
-				if "CAP * ACK :twitch.tv/tags" in line:
-					self.granted_capabilities.append("tags")
-					if self.debug:
-						print("Tags capability granted.")
-				if "End of /NAMES list" in line: # keep loading until end of names list
-					success = True
-
-		# Sometimes the above will initialise the bot completely.
-		# However if Capabilities are requested, sometimes they can come through in the wrong order
-		# So if we've not heard back the ACK for all of the requested capabilities, we try another receive:
-
-		if len(self.requested_capabilities) != len(self.granted_capabilities): # not all requesed capabilities are granted
-			next_bytes = self.socket.recv(4096).decode("utf-8")
-			readbuffer += str(next_bytes)
-			response_lines = readbuffer.split("\r\n") # this might contain the first chat message - if so it won't be processed.
-
-			for line in response_lines:
+	def _pop_lines(self):
+		"""
+		Removes all complete lines from the read buffer and returns them as a list of bytes, without line endings.
+		Anything after the last line ending is left in the buffer, to be completed by the next receive.
+		"""
+		end_of_lines = self._readbuffer.rfind(b"\r\n")
+		if end_of_lines == -1:
+			if len(self._readbuffer) > _MAX_READBUFFER:
 				if self.debug:
-					print(line)
-				if "CAP * ACK :twitch.tv/membership" in line:
-					self.granted_capabilities.append("membership")
-					if self.debug:
-						print("Membership capability granted (on second receive).")
-				if "CAP * ACK :twitch.tv/commands" in line:
-					self.granted_capabilities.append("commands")
-					if self.debug:
-						print("Commands capability granted (on second receive).")
-				if "CAP * ACK :twitch.tv/tags" in line:
-					self.granted_capabilities.append("tags")
-					if self.debug:
-						print("Tags capability granted (on second receive).")
+					self._log.debug("Discarding read buffer - too much data received without a line ending.")
+				self._readbuffer.clear()
+			return []
 
-		self.initialised = True
+		lines = bytes(self._readbuffer[:end_of_lines]).split(b"\r\n")
+		del self._readbuffer[:end_of_lines+2]
+		return lines
 
-	def get_messages(self):
+	def get_messages(self, timeout=None):
 		"""
 		Receives new messages from chat.
 		
@@ -146,187 +344,151 @@ class ChatBot():
 		message_type is "privmsg" for chat messages or "notice" for channel notices. Twitch may send other message types too.
 		See https://dev.twitch.tv/docs/irc/commands for "command" message types (only sent if "commands" capability is enabled)
 		This function will listen for new messages and only return after a new message is received in the chat.
+		If timeout (in seconds) is given, it will instead return an empty list if nothing is received within that time.
 		"""
 
-		#if not self.initialised:
-		#	raise NotInitialisedException("The chatbot must be initialised before a message can be sent.")
+		if not self.initialised:
+			raise NotInitialisedException("The chatbot must be initialised before messages can be received.")
+
+		recv_into = self._recv_into
+		if not self._selector.select(timeout): # wait until there's something to read
+			return [] # timed out
 
+		# Read everything that has arrived, rather than one small chunk per call.
+		# The number of reads is capped so that a constant stream of data can't keep us here forever.
+		recv_buffer = self._recv_buffer
+		readbuffer  = self._readbuffer
 		try:
-			next_bytes = self.socket.recv(4096).decode("utf-8")
-		except AttributeError:
-			raise NotInitialisedException("The chatbot must be initialised before messages can be received.")
-			
-		lines = next_bytes.split("\r\n")
+			for _ in range(16):
+				bytes_received = recv_into(recv_buffer) # left as bytes - only the parts of each line returned to the user are decoded
+				if not bytes_received: # connection closed
+					break
+				readbuffer += recv_buffer[:bytes_received]
+				if len(readbuffer) >= _MAX_READBUFFER:
+					break
+		except BlockingIOError:
+			pass # nothing left to read
+
+		lines = self._pop_lines() # a line can be split across two receives - the end of it will be processed next time
 
 		messages = []
 
+		# looked up once here rather than for every line
+		add_message = messages.append
+		debug = self.debug
+		log   = self._log
+		get_handler = _DISPATCH.get
+
 		for line in lines:
-			if self.debug:
-				print(line)
+			if debug:
+				log.debug(line.decode("utf-8", "replace"))
 
-			if line == "":
+			if line == b"":
 				continue
 
-			if line[:4] == "PING":
+			if line.startswith(_PING):
 				self.send_pong()
 				continue
 
-			"""
-			As this uses "if x in line" to detect message types, in theory someone could send a message in chat saying
-			 e.g. "hey guys tmi.twitch.tv NOTICE #", so that line would have both PRIVMSG and (e.g.) "tmi.twitch.tv NOTICE #"
-			in it. By checking for PRIVMSG first, no matter the content of the message it will always be processed as a chat 
-			message. Kind of like sanitising it. Sort of.
-			"""
-
-			message_dict = None # will be set to a dict below if message type is recognised
-
-			if "tmi.twitch.tv PRIVMSG #" in line: # chat message from user (other message types are possible e.g. NOTICE)
-				message_dict = {"message_type":"privmsg"}
-
-				try:
-					if "tags" in self.granted_capabilities and line[0] == "@":
-						line = line[1:] # remove the @ from the beginning
-
-						# first section is all tags except last one, then we add the last one to the list by a different method
-						msg_tags = (";".join(line.split("PRIVMSG")[0].split(";")[:-1]) + ";" + (line.split("PRIVMSG")[0].split(":")[-2]).split(";")[-1]).split(";") # dumb that I have to do this
-						for tag in msg_tags:
-							if "=" in tag:
-								key, val = tag.split("=")
-								message_dict[key.strip()] = val.strip()
-					else:
-						start_of_name = line.index(":") + 1
-						end_of_name = line.index("!")
-						username = line[start_of_name:end_of_name].lower()
-						if 4 <= len(username) <= 25: # min and max lengths for username.. just a sanity check
-							message_dict["display-name"] = username
-						else:
-							raise ValueError("Unable to find username in line.")
-					message_dict["message"] = ":".join(line.split("PRIVMSG")[1].split(":")[1:]) # everything after the PRIVMSG.. then after the subsequent colon
-				except (ValueError, IndexError) as ex:
-					if self.debug:
-						print(f"Unable to parse line as message: \n\n{line} \n\n{str(ex)}")
-					continue # bad line
-
-			elif "tmi.twitch.tv NOTICE #" in line:
-				"""Example NOTICE message: @msg-id=color_changed :tmi.twitch.tv NOTICE #kaywee :Your color has been changed."""
-				message_dict = {"message_type":"notice"}
-				line = line[1:] # remove the @ from the beginning
-				message_dict["msg_id"]  = line.split(":")[0][:-1].split("=")[1]
-				message_dict["message"] = line.split(":")[-1]
-
-			elif "tmi.twitch.tv USERNOTICE #" in line:
-				message_dict = {"message_type":"usernotice"}
-				line = line[1:] # remove leading @
-				msg_tags = (";".join(line.split("USERNOTICE")[0].split(";")[:-1]) + ";" + (line.split("USERNOTICE")[0].split(":")[-2]).split(";")[-1]).split(";") # dumb that I have to do this
-
-				for tag in msg_tags:
-					if "=" in tag: # sanity check - all should have key=value
-						key, val = tag.split("=")
-						message_dict[key.strip()] = val.strip()
-
-			elif ":tmi.twitch.tv USERSTATE" in line:
-				"""Example message:
-				@badge-info=subscriber/7;badges=moderator/1,subscriber/6;color=#FF69B4;display-name=RoboKaywee;
-				emote-sets=0,300374282,300542926,537206155,564265402,592920959,610186276;mod=1;subscriber=1;user-type=mod :tmi.twitch.tv USERSTATE #kaywee
-				"""
-				message_dict = {"message_type":"userstate"} # what info comes with this?
-
-				line = line[1:] # remove leading @
-				msg_tags = (";".join(line.split("USERSTATE")[0].split(";")[:-1]) + ";" + (line.split("USERSTATE")[0].split(":")[-2]).split(";")[-1]).split(";") # dumb that I have to do this
-
-				for tag in msg_tags:
-					if "=" in tag: # sanity check - all should have key=value
-						key, val = tag.split("=")
-						message_dict[key.strip()] = val.strip()
-
-			elif ":tmi.twitch.tv HOSTTARGET" in line:
-				target = line.split(":")[2].split(" ")[0]
-				if target not in ["-", ""]:
-					viewers = line.split(":")[2].split(" ")[1]
-					message_dict = {"message_type":"hosttarget", "host_target": target, "viewers": viewers}
-
-			elif ":tmi.twitch.tv RECONNECT" in line: # a command to reconnect to chat
-				self.reset_socket() # reconnect to chat per twitch's request
-				continue # don't return this as a message type
-
-			elif ":tmi.twitch.tv CLEARMSG" in line: # single message was deleted
-				message_dict = {"message_type":"clearmsg"} 
-				if "tags" in self.granted_capabilities and line[0] == "@":
-					msg_tags = line[1:].split(":tmi.twitch.tv CLEARMSG")[0].split(";")
-					for tag in msg_tags:
-						if "=" in tag:
-							key, val = tag.split("=")
-							message_dict[key.strip()] = val.strip()
-
-			elif ":tmi.twitch.tv CLEARCHAT" in line: # clear all messages from user
-				message_dict = {"message_type":"clearchat"}
-				if "tags" in self.granted_capabilities and line[0] == "@":
-					msg_tags = line[1:].split(":tmi.twitch.tv CLEARCHAT")[0].split(";")
-					for tag in msg_tags:
-						if "=" in tag: # sanity check - all should have key=value
-							key, val = tag.split("=")
-							message_dict[key.strip()] = val.strip()
-
-			elif ":tmi.twitch.tv ROOMSTATE" in line:
-				"""Example message:
-				@room-id=136108665;subs-only=0 :tmi.twitch.tv ROOMSTATE #kaywee
-				"""
-				message_dict = {"message_type":"roomstate"}
-				line = line[1:] # remove leading @
-
-				msg_tags = (";".join(line.split("ROOMSTATE")[0].split(";")[:-1]) + ";" + (line.split("ROOMSTATE")[0].split(":")[-2]).split(";")[-1]).split(";") # dumb that I have to do this
-
-				for tag in msg_tags:
-					if "=" in tag: # sanity check - all should have key=value
-						key, val = tag.split("=")
-						message_dict[key.strip()] = val.strip()
-
-			elif line.startswith("@badge-info="):
-				message_dict = {"message_type":"badge-info"}
-				line = line[12:] # remove leading "@badge-info="
-
-				msg_tags = line.split(";")
-				for tag in msg_tags:
-					if "=" in tag: # sanity check - all should have key=value
-						key, val = tag.split("=")
-						message_dict[key.strip()] = val.strip()
-
+			# The command is read from its fixed position after the optional @tags and :prefix sections, rather than
+			# searched for anywhere in the line, so a chat message containing e.g. "tmi.twitch.tv NOTICE #" can never
+			# be mistaken for a different message type.
+			start_of_command = 0
+			if line[0:1] == b"@":
+				start_of_command = line.find(b" ") + 1
+			if line.startswith(_SERVER_PREFIX, start_of_command): # most lines other than chat messages come from the server itself
+				start_of_command += len(_SERVER_PREFIX)
+			elif line.startswith(b":", start_of_command):
+				start_of_command = line.find(b" ", start_of_command) + 1
+			end_of_command = line.find(b" ", start_of_command)
+			if end_of_command == -1:
+				end_of_command = len(line)
+			command = line[start_of_command:end_of_command]
+
+			if command == b"PRIVMSG": # chat message from user - by far the most common, so skip the lookup
+				message_dict = _handle_privmsg(line, self, end_of_command)
 			else:
-				with open("verbose log.txt", "a", encoding="utf-8") as f:
-					f.write("Unrecognised line received in Chatbot: " + str(line) + "\n\n")
+				message_dict = get_handler(command, _handle_unknown)(line, self, end_of_command)
 
 			if message_dict is not None:
-				messages.append(message_dict)
+				add_message(message_dict)
+
+		if self._verbose_log is not None:
+			self._verbose_log.flush() # one write for all of this batch's unrecognised lines (does nothing if there weren't any)
+		if debug:
+			self._flush_log()
 
 		return messages
 
 	def send_message(self, msg):
 		"""Send a message to the channel."""
 
+		sendall = self._sendall
+		prefix  = self._privmsg_prefix
 		msg = msg.replace("\n", " ").replace("\r", "")
 		if len(msg) < 500:
-			bytes_message = ("PRIVMSG #" + self.channel + " :" + msg + "\r\n").encode('utf-8')
-			self.socket.send(bytes_message)
+			sendall(b"".join((prefix, msg.encode('utf-8'), b"\r\n"))) # only the message itself needs encoding, and join builds it in one go
 		else:
 			chr_limit = 495
 			
-			chunks = [msg[i:i+chr_limit] for i in range(0, len(msg), chr_limit)]
-			for chunk in chunks:
-				bytes_message = ("PRIVMSG #" + self.channel + " :" + chunk + "\r\n").encode('utf-8')
+			chunks = [b"".join((prefix, msg[i:i+chr_limit].encode('utf-8'), b"\r\n")) for i in range(0, len(msg), chr_limit)]
+			for bytes_message in chunks:
+				sendall(bytes_message)
+				sleep(0.2)
 
-				try:
-					self.socket.send(bytes_message)
-					sleep(0.2)
-				except AttributeError:
-					raise NotInitialisedException("The chatbot must be initialised before a message can be sent.")
+	def _sendall(self, data):
+		"""
+		Sends all of data to the server.
+
+		A single send can write only part of the data, and once logged in the socket is non-blocking, so socket.sendall
+		would give up part way through a line if the send buffer filled. Instead, this waits for room and carries on.
+		Raises TimeoutError if the server stops reading for long enough that there's never room.
+		"""
+		if not self.initialised:
+			raise NotInitialisedException("The chatbot must be initialised before a message can be sent.")
+
+		try:
+			sent = self._send(data)
+		except BlockingIOError:
+			sent = 0
+
+		if sent < len(data): # rare - only when the send buffer is full
+			data = memoryview(data)
+			with DefaultSelector() as write_selector: # separate from self._selector, which only waits for something to read
+				write_selector.register(self.socket, EVENT_WRITE)
+				while sent < len(data):
+					if not write_selector.select(_SEND_TIMEOUT): # wait until there's room in the send buffer
+						raise TimeoutError("Unable to send to Twitch: the server stopped accepting data.")
+					try:
+						sent += self._send(data[sent:])
+					except BlockingIOError:
+						pass
+
+	def _flush_log(self):
+		"""Writes out any buffered debug messages."""
+		for handler in self._log.handlers:
+			handler.flush()
 
 	def send_pong(self):
-		msg = "PONG :tmi.twitch.tv\r\n".encode('utf-8')
-		self.socket.send(msg)
+		self._sendall(_PONG_MSG)
 		if self.debug:
-			print("Sent pong.")
+			self._log.debug("Sent pong.")
+
+	def close(self):
+		"""Closes the connection to chat, and writes out any debug messages or unrecognised lines which are still waiting to be written."""
+		if self._verbose_log is not None:
+			self._verbose_log.close()
+			self._verbose_log = None
+		self._flush_log()
+		self._close_socket()
+
+	def _close_socket(self):
+		"""Closes the socket. Until a new one is opened, receiving or sending raises NotInitialisedException."""
+		self.initialised = False
+		self._selector.close()
+		self.socket.close()
 
 	def reset_socket(self):
 		"""Re-creates the socket object"""
-		del self.socket
+		self._close_socket() # closed explicitly, as the selector and bound methods would otherwise keep the old connection open
 		self._open_socket()